@@ -18,182 +18,318 @@ Uninstall OPA packages
 opaf uninstall --id <your artifact id> [--version <your version>]
 """
 import argparse
+import io
 import os
-import subprocess
+import shutil
 import sys
-
-import ruamel.yaml
-import json
+import tarfile
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+import requests
+import yaml
 import logging
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
-def build_logger(name):
-    logger = logging.getLogger(name)
-    console_handler = logging.StreamHandler()
-    logger.addHandler(console_handler)
-    return logger
 
+logger = logging.getLogger('opa fetch')
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-                    datefmt='%m-%d %H:%M')
+OPA_SITE_PACKAGES = os.environ.get('OPAF_SITE_PACKAGES', "/usr/local/lib/opa/site-packages")
+DEFAULT_REPO = os.environ.get('OPAF_DEFAULT_REPO', "generic-local")
+ARTIFACTORY_HOST = os.environ.get('ARTIFACTORY_HOST', '')
 
-logger = build_logger('opa fetch')
+IO_BUFFER_SIZE = 1 << 20  # tar reads default to 512B blocks; 1MB keeps gzip/tar I/O off the syscall floor
+MAX_DOWNLOAD_WORKERS = 8
+MAX_IN_FLIGHT_TARBALLS = 16
+SPOOL_MAX_SIZE = 1 << 25  # tarballs up to 32MB wait in memory between stages; larger ones spill to disk
+PARSE_CACHE_MAX_ENTRIES = 100
 
-yaml2Dict = ruamel.yaml.YAML()
+# Maps path -> (mtime, size, parsed), evicting the least recently used entry.
+_PARSE_CACHE = OrderedDict()
 
-OPA_SITE_PACKAGES = "/usr/local/lib/opa/site-packages"
-DEFAULT_REPO = "generic-local"
+_SESSION = requests.Session()
+_SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=8))
 
 
 # sample path: /artifactory/generic-local/bnsopa-maestro-policies/0.0.1/bnsopa-maestro-policies-0.0.1.tar.gz
 
 
+@dataclass(slots=True)
 class Artifact:
+    artifact_name: str
+    version: str
+    artifact_path: str = field(init=False)
+    # Per-instance cache rather than lru_cache, which would pin every Artifact it sees.
+    _url_cache: dict = field(init=False, repr=False, default_factory=dict)
 
-    def __init__(self, artifact_name, version):
-        self.artifact_path = "%s/%s/%s-%s.tar.gz" % (artifact_name, version, artifact_name, version)
+    def __post_init__(self):
+        self.artifact_path = f"{self.artifact_name}/{self.version}/{self.artifact_name}-{self.version}.tar.gz"
 
     def with_repo(self, repo):
-        af_path = "artifactory/" + repo + "/" + self.artifact_path
-        return "https://${ARTIFACTORY_HOST}/%s" % af_path
+        url = self._url_cache.get(repo)
+        if url is None:
+            url = f"https://{ARTIFACTORY_HOST}/artifactory/{repo}/{self.artifact_path}"
+            self._url_cache[repo] = url
+        return url
 
 
 def install_artifacts_from_requirements_file(path_to_dependencies):
     repos, requirements = parse_requirements_file(path_to_dependencies)
-    for name, version in requirements:
-        opa_package_path = get_opa_package_path(name, version)
-        artifact = Artifact(name, version)
-        install_artifact(artifact, opa_package_path, repos)
+    download_workers = max(1, min(MAX_DOWNLOAD_WORKERS, len(requirements)))
+    extract_workers = max(1, min(os.cpu_count() or 1, len(requirements)))
+    in_flight_tarballs = threading.BoundedSemaphore(MAX_IN_FLIGHT_TARBALLS)
+    with ThreadPoolExecutor(max_workers=download_workers) as download_pool, \
+            ThreadPoolExecutor(max_workers=extract_workers) as extract_pool:
+        download_futures = {
+            download_pool.submit(download_stage, artifact, site_package_path, repos, in_flight_tarballs):
+                site_package_path
+            for artifact, site_package_path in iter_install_jobs(requirements)
+        }
+        extract_futures = []
+        try:
+            for download_future in as_completed(list(download_futures)):
+                site_package_path = download_futures.pop(download_future)
+                tarball_blob = download_future.result()
+                if tarball_blob is not None:
+                    extract_futures.append(
+                        extract_pool.submit(extract_stage, tarball_blob, site_package_path, in_flight_tarballs))
+        except BaseException:
+            discard_pending_downloads(download_futures, in_flight_tarballs)
+            raise
+        for extract_future in extract_futures:
+            extract_future.result()
+
+
+def download_stage(artifact, site_package_path, repos, in_flight_tarballs):
+    if already_installed(site_package_path):
+        logger.debug("Artifact %s already installed, skipping download", artifact.artifact_path)
+        return None
+    in_flight_tarballs.acquire()
+    try:
+        tarball_blob = download(artifact, repos)
+    except requests.RequestException as e:
+        in_flight_tarballs.release()
+        logger.error("Failed to download artifact %s: %s", artifact.artifact_path, e)
+        return None
+    except BaseException:
+        in_flight_tarballs.release()
+        raise
+    if tarball_blob is None:
+        in_flight_tarballs.release()
+        logger.warning(
+            "Could not find artifact with path %s in any of the given repositories", artifact.artifact_path
+        )
+    return tarball_blob
+
+
+def discard_pending_downloads(download_futures, in_flight_tarballs):
+    # Close blobs that finished downloading but were never handed to the
+    # extract pool, releasing their in-flight slots so workers blocked in
+    # acquire() and the executors' shutdown can proceed.
+    for download_future in download_futures:
+        download_future.cancel()
+    for download_future in download_futures:
+        if download_future.cancelled():
+            continue
+        try:
+            tarball_blob = download_future.result()
+        except BaseException:
+            continue
+        if tarball_blob is not None:
+            tarball_blob.close()
+            in_flight_tarballs.release()
+
+
+def extract_stage(tarball_blob, site_package_path, in_flight_tarballs):
+    try:
+        with tarball_blob:
+            extract_artifact(tarball_blob, site_package_path)
+    finally:
+        in_flight_tarballs.release()
+
+
+def iter_install_jobs(requirements):
+    for name, version in requirements.items():
+        yield Artifact(name, version), get_opa_package_path(name, version)
 
 
 def parse_requirements_file(path_to_dependencies):
-    requirements_file_map = yaml2Dict.load(path_to_dependencies)
+    file_stat = os.stat(path_to_dependencies)
+    cached = _PARSE_CACHE.get(path_to_dependencies)
+    if cached is not None and cached[:2] == (file_stat.st_mtime, file_stat.st_size):
+        _PARSE_CACHE.move_to_end(path_to_dependencies)
+        return cached[2]
+    with open(path_to_dependencies, 'rb') as requirements_file:
+        requirements_file_map = yaml.load(requirements_file, Loader=YamlLoader)
     repos = requirements_file_map.get('repositories')  # Okay to be null
     requirements = requirements_file_map['requirements']  # This must be present
+    _PARSE_CACHE[path_to_dependencies] = (file_stat.st_mtime, file_stat.st_size, (repos, requirements))
+    if len(_PARSE_CACHE) > PARSE_CACHE_MAX_ENTRIES:
+        _PARSE_CACHE.popitem(last=False)
     return repos, requirements
 
 
 def install_artifact(artifact, site_package_path, repos):
-    artifact_downloaded = download(artifact, repos, site_package_path)
-    if artifact_downloaded:
-        extract_artifact(site_package_path)
-    else:
-        logger.warning(
-            "Could not find artifact with path %s in any of the given repositories" % artifact.artifact_path
-        )
+    in_flight_tarballs = threading.BoundedSemaphore(1)
+    tarball_blob = download_stage(artifact, site_package_path, repos, in_flight_tarballs)
+    if tarball_blob is not None:
+        extract_stage(tarball_blob, site_package_path, in_flight_tarballs)
 
 
-def extract_artifact(site_package_path):
-    execute_command('tar xf %s --strip-components=1' % site_package_path)
-    execute_command('rm site_package_path')
+def already_installed(site_package_path):
+    return os.path.isdir(site_package_path) and len(os.listdir(site_package_path)) > 0
 
 
-def download(artifact, repos, site_package_path):
+def extract_artifact(tar_stream, site_package_path):
+    # Extract into a staging directory and rename into place on success, so
+    # an interrupted extraction never leaves a partial package directory that
+    # already_installed would mistake for a finished install.
+    parent_dir = os.path.dirname(site_package_path)
+    os.makedirs(parent_dir, exist_ok=True)
+    staging_path = tempfile.mkdtemp(prefix=os.path.basename(site_package_path) + '.partial-', dir=parent_dir)
+    try:
+        buffered_stream = io.BufferedReader(tar_stream, buffer_size=IO_BUFFER_SIZE)
+        with tarfile.open(fileobj=buffered_stream, mode='r|*', bufsize=IO_BUFFER_SIZE) as tar:
+            for member in tar:
+                stripped_name = strip_leading_component(member.name)
+                if stripped_name is None:
+                    continue
+                member.name = stripped_name
+                tar.extract(member, staging_path, filter='data')
+        os.chmod(staging_path, 0o755)
+        shutil.rmtree(site_package_path, ignore_errors=True)
+        os.rename(staging_path, site_package_path)
+    except BaseException:
+        shutil.rmtree(staging_path, ignore_errors=True)
+        raise
+
+
+def strip_leading_component(member_name):
+    # Mirrors tar --strip-components=1: drop the archive's top-level directory.
+    # Traversal protection (absolute names, '..', escaping link targets) is
+    # handled by the 'data' extraction filter.
+    parts = member_name.split('/', 1)
+    if len(parts) < 2 or not parts[1]:
+        return None
+    return parts[1]
+
+
+def download(artifact, repos):
     if repos is None:
-        return try_downloading_from_this_repo(artifact, site_package_path, DEFAULT_REPO)
-    return try_downloading_from_all_repos(artifact, site_package_path, repos)
+        return try_downloading_from_this_repo(artifact, DEFAULT_REPO)
+    return try_downloading_from_all_repos(artifact, repos)
 
 
-def try_downloading_from_all_repos(artifact, repos, site_package_path):
-    artifact_piped_to_site_package = False
-    repo_index = 0
-    while not artifact_piped_to_site_package and repo_index < len(repos):
-        repo = repos[repo_index]
-        artifact_piped_to_site_package = try_downloading_from_this_repo(artifact, site_package_path, repo)
-        repo_index += 1
-    return artifact_piped_to_site_package
+def try_downloading_from_all_repos(artifact, repos):
+    return next(filter(None, (try_downloading_from_this_repo(artifact, repo) for repo in repos)), None)
 
 
-def try_downloading_from_this_repo(artifact, repo, site_package_tar_dump_path):
-    try:
-        artifactory_url = artifact.with_repo(repo)
-        return download_to_path(artifactory_url, site_package_tar_dump_path)
-    except Exception as e:
-        logger.error(e)
-        return False
+def try_downloading_from_this_repo(artifact, repo):
+    artifactory_url = artifact.with_repo(repo)
+    return download_to_spool(artifactory_url)
 
 
+@lru_cache(maxsize=1024)
 def get_opa_package_path(artifact_name, version):
     return OPA_SITE_PACKAGES + "/%s/%s" % (artifact_name, version)
 
 
-def download_to_path(resource_url, path):
-    command = "curl %s >> %s" % (resource_url, path)
-    data = execute_command(command)
-    return check_if_resource_piped_to_path(data)
-
-
-def execute_command(command):
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-    process.wait()
-    data, err = process.communicate()
-    raise_exception_if_process_exited_abnormally(err, process)
-    return data
-
-
-def raise_exception_if_process_exited_abnormally(err, process):
-    if err:  # check stderr for messages, even if process return code is 0
-        raise Exception(err)
-    elif process.returncode != 0:
-        raise Exception("Error during curl request!")
-
-
-def check_if_resource_piped_to_path(curl_output):
-    """
-    :param curl_output: The output of the curl process.
-    :return: true if the AF resource was successfully piped to the path
-    :raise Exception if an error other than 404 occurred
+def download_to_spool(resource_url):
     """
-    decoded = curl_output.decode('utf-8')
-    errors = json.loads(decoded)['errors']
-    if len(errors) > 0:
-        return False
-    return True
+    Stream the resource at resource_url over the pooled session into a
+    spooled temporary file, ready for the extract stage.
 
-
-def build_arg_parser(args):
+    :return: the rewound spool, or None if the resource was not found
+    :raise HTTPError if an error other than 404 occurred
+    """
+    with _SESSION.get(resource_url, stream=True, auth=get_artifactory_credentials()) as response:
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        tarball_blob = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        # iter_content (unlike reading response.raw) wraps mid-body urllib3
+        # errors in requests.RequestException, keeping failures per-artifact.
+        for chunk in response.iter_content(IO_BUFFER_SIZE):
+            tarball_blob.write(chunk)
+    tarball_blob.seek(0)
+    return tarball_blob
+
+
+def get_artifactory_credentials():
+    username = os.environ.get('ARTIFACTORY_USERNAME_READONLY')
+    password = os.environ.get('ARTIFACTORY_PASSWORD_READONLY')
+    if username is None:
+        return None
+    return username, password
+
+
+def build_arg_parser():
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=argparse.RawDescriptionHelpFormatter,
                                      prog='opaf')
-    required_group = parser.add_argument_group('Required arguments.')
-    if args[0] == "install":
-        if args[1] == '--read':
-            required_group.add_argument('--read', help='The path to the opa package requirements file.', required=True)
-        else:
-            required_group.add_argument('--id', help='The artifact id.', required=True)
-            required_group.add_argument('--version', help='The artifact version.', required=True)
-            required_group.add_argument('--repo', help='The artifact repo.', required=False)
-    elif args[0] == "uninstall":
-        required_group.add_argument('--id', help='The artifact id.', required=True)
-        required_group.add_argument('--version', help='The artifact version.', required=False)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    install_parser = subparsers.add_parser('install', help='Install OPA packages.')
+    install_parser.add_argument('--read', help='The path to the opa package requirements file.')
+    install_parser.add_argument('--id', help='The artifact id.')
+    install_parser.add_argument('--version', help='The artifact version.')
+    install_parser.add_argument('--repo', help='The artifact repo.')
+    uninstall_parser = subparsers.add_parser('uninstall', help='Uninstall OPA packages.')
+    uninstall_parser.add_argument('--id', help='The artifact id.', required=True)
+    uninstall_parser.add_argument('--version', help='The artifact version.')
     return parser
 
 
+PARSER = build_arg_parser()
+
+
 def install_package(parsed_args):
-    if not parsed_args.read:
+    if parsed_args.read:
         install_artifacts_from_requirements_file(parsed_args.read)
+    elif not (parsed_args.id and parsed_args.version):
+        PARSER.error('install requires either --read or both --id and --version')
     else:
         name, version, repo = parsed_args.id, parsed_args.version, parsed_args.repo
         opa_package_path = get_opa_package_path(name, version)
         artifact = Artifact(name, version)
-        install_artifact(artifact, opa_package_path, [repo])
+        install_artifact(artifact, opa_package_path, [repo] if repo else None)
 
 
 def uninstall_package(parsed_args):
     path = OPA_SITE_PACKAGES + '/' + parsed_args.id
     if parsed_args.version:
         path += '/' + parsed_args.version
-    execute_command("rm -rf " + path)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+COMMAND_HANDLERS = {
+    'install': install_package,
+    'uninstall': uninstall_package,
+}
+
+
+def configure_logging():
+    level = os.environ.get('OPAF_LOG_LEVEL', 'INFO').upper()
+    if level == 'DEBUG':
+        logging.basicConfig(level=level,
+                            format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                            datefmt='%m-%d %H:%M')
+    else:
+        # Skip %(asctime)s so ordinary runs never pay strftime per record.
+        logging.basicConfig(level=level, format='%(levelname)s %(name)s: %(message)s')
 
 
 def main(args):
-    parser = build_arg_parser(args)
-    parsed_args = parser.parse_args(args)
-    if args[0] == 'install':
-        install_package(parsed_args)
-    elif args[0] == 'uninstall':
-        uninstall_package(parsed_args)
+    configure_logging()
+    parsed_args = PARSER.parse_args(args)
+    COMMAND_HANDLERS[parsed_args.command](parsed_args)
 
 
 if __name__ == '__main__':
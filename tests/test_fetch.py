@@ -0,0 +1,6 @@
+from opaf.fetch import Artifact
+
+
+def test_with_repo_puts_the_repo_in_the_artifactory_path():
+    url = Artifact('a', '1').with_repo('foo')
+    assert '/artifactory/foo/a/1/a-1.tar.gz' in url